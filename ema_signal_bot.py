@@ -1,17 +1,28 @@
 import os
 import time
 import json
+import hashlib
 import logging
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 
 from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton, Update
 from telegram.ext import Updater, CallbackContext, CommandHandler, CallbackQueryHandler, Dispatcher
 
+from fast_ewma import (
+    BUY_ENTRY, BUY_EXIT, SELL_ENTRY, SELL_EXIT, crossover_signals, ema_warmup, ema_warmup_batch,
+    make_ema_step,
+)
+
 # -------------------
 # Load environment variables
 load_dotenv()
@@ -21,10 +32,16 @@ ALPHA_VANTAGE_API_KEY = os.getenv("AV_API_KEY")
 # -------------------
 # Config
 CHECK_INTERVAL_SECONDS = 60
+FETCH_WORKERS = 5  # concurrent Alpha Vantage requests (free tier: 5 req/min)
+HTTP_TIMEOUT_SECONDS = 10
+RATE_LIMIT_PER_MINUTE = 5  # Alpha Vantage free tier
+MAX_BACKOFF_SECONDS = 900  # cap for pairs that keep returning no data
 PAIRS = ["EURUSD"]  # Forex pairs
 TREND_EMA = 32
 ENTRY_EXIT_EMA = 14
 TIMEFRAME = "15min"  # Alpha Vantage allowed: 1min,5min,15min,30min,60min
+BATCH_WARMUP_MIN_PAIRS = 8  # warm up more pairs than this in one matrix pass
+CACHE_SKEW_SECONDS = 5  # grace period after a bar is due before refetching
 STATE_FILE = "bot_state.json"
 LOG_FILE = "ema_signal_bot.log"
 
@@ -63,15 +80,91 @@ def load_state():
         s["per_pair"].setdefault(p, {"in_trade": False, "side": None})
     return s
 
+# Guards every change to `state` together with its save: the monitoring thread
+# holds it for a whole evaluate + flush, handlers for their change + save
+_state_lock = threading.RLock()
+_state_dirty = False
+
+def _json_default(o):
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
 def save_state(s):
-    with open(STATE_FILE, "w") as f:
-        json.dump(s, f, indent=2)
+    global _state_dirty
+    # Write to a temp file and swap it in so a crash never leaves a partial file
+    with _state_lock:
+        tmp = STATE_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(s, f, indent=2, default=_json_default)
+        os.replace(tmp, STATE_FILE)
+        _state_dirty = False
+
+def mark_state_dirty():
+    global _state_dirty
+    _state_dirty = True
+
+def flush_state():
+    if _state_dirty:
+        save_state(state)
 
 state = load_state()
 
 # -------------------
 # Fetch Forex OHLC from Alpha Vantage
+# One keep-alive session shared by the fetch workers; retries 429/5xx with backoff
+SESSION = requests.Session()
+SESSION.headers.update({"Accept-Encoding": "gzip"})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+_ohlc_cache = {}  # (pair, interval, outputsize) -> (UTC expires_at, (times, closes))
+_no_data = {}  # pair -> (consecutive failures, monotonic retry_at)
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.refill_per_second
+            time.sleep(wait)
+
+rate_limiter = TokenBucket(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_PER_MINUTE / 60)
+
+def interval_seconds(interval):
+    return int(interval.replace("min", "")) * 60
+
+def evict_ohlc_cache(pair):
+    # list() snapshot: fetch workers may insert while the handler thread iterates
+    for k in [k for k in list(_ohlc_cache) if k[0] == pair]:
+        _ohlc_cache.pop(k, None)
+    _no_data.pop(pair, None)
+
 def fetch_ohlc_fx(pair, interval, outputsize="compact"):
+    # Bars only change once per interval, so serve repeat calls from memory
+    # until the next bar is due (Alpha Vantage FX timestamps are UTC)
+    cache_key = (pair, interval, outputsize)
+    cached = _ohlc_cache.get(cache_key)
+    if cached is not None and np.datetime64(datetime.utcnow(), "s") < cached[0]:
+        return cached[1]
+    failures, retry_at = _no_data.get(pair, (0, 0.0))
+    if time.monotonic() < retry_at:
+        return None
     from_sym = pair[:3]
     to_sym = pair[3:]
     url = "https://www.alphavantage.co/query"
@@ -84,28 +177,27 @@ def fetch_ohlc_fx(pair, interval, outputsize="compact"):
         "outputsize": outputsize,
         "datatype": "json",
     }
-    r = requests.get(url, params=params)
-    data = r.json()
+    rate_limiter.acquire()
+    r = SESSION.get(url, params=params, timeout=HTTP_TIMEOUT_SECONDS)
+    data = orjson.loads(r.content)
     key = f"Time Series FX ({interval})"
-    if key not in data:
-        logger.warning("No data for %s %s: %s", pair, interval, data)
+    series = data.get(key)
+    if not series:
+        # Error or throttling note instead of bars: back off exponentially
+        failures += 1
+        delay = min(CHECK_INTERVAL_SECONDS * 2 ** (failures - 1), MAX_BACKOFF_SECONDS)
+        _no_data[pair] = (failures, time.monotonic() + delay)
+        logger.warning("No data for %s %s (retry in %ds): %s", pair, interval, delay, data)
         return None
-    df = pd.DataFrame.from_dict(data[key], orient="index")
-    df = df.rename(columns={
-        "1. open": "Open",
-        "2. high": "High",
-        "3. low": "Low",
-        "4. close": "Close"
-    })
-    df.index = pd.to_datetime(df.index)
-    df = df.sort_index()
-    return df
-
-def add_ema(df, period, col="Close", name=None):
-    if name is None:
-        name = f"EMA_{period}"
-    df[name] = df[col].astype(float).ewm(span=period, adjust=False).mean()
-    return df
+    _no_data.pop(pair, None)
+    times, bars = zip(*sorted(series.items()))
+    times = np.array([datetime.fromisoformat(t) for t in times], dtype="datetime64[s]")
+    closes = np.fromiter((float(b["4. close"]) for b in bars), dtype=np.float32, count=len(bars))
+    # The bar stamped times[-1] completes one interval after its stamp, so the
+    # next bar is published two intervals after it
+    expires_at = times[-1] + np.timedelta64(2 * interval_seconds(interval) + CACHE_SKEW_SECONDS, "s")
+    _ohlc_cache[cache_key] = (expires_at, (times, closes))
+    return times, closes
 
 # -------------------
 # Telegram UI
@@ -122,53 +214,213 @@ def send_message(chat_id, text):
 
 # -------------------
 # EMA signal logic
-def evaluate_pair(pair, chat_id):
-    df = fetch_ohlc_fx(pair, state["timeframe"])
-    if df is None or df.empty:
-        return
-    df = add_ema(df, state["trend_ema"], name="TrendEMA")
-    df = add_ema(df, state["entry_exit_ema"], name="EntryEMA")
-    latest = df.iloc[-1]
-    prev = df.iloc[-2] if len(df)>=2 else latest
-    close = float(latest["Close"])
-    trend = float(latest["TrendEMA"])
-    entry = float(latest["EntryEMA"])
+EMA_FIELDS = ("trend_ema_val", "entry_ema_val", "closes_buf", "head", "last_ts", "config_hash")
+
+# Settings the EMAs depend on; evaluate_pairs reads them once per tick so a
+# /setema arriving mid-tick cannot mix old and new periods
+def current_ema_config():
+    return state["timeframe"], state["trend_ema"], state["entry_exit_ema"]
+
+# Identifies the settings the stored EMAs were computed with; kept as a plain
+# string because hash() of str is salted per process and would not survive restarts
+def ema_config_hash(config):
+    return ":".join(str(v) for v in config)
+
+# Pairs without seeded EMAs fetch the full history once to warm up on. EMAs
+# restored from disk are reused unless they were computed with other settings.
+def needs_warmup(pair):
+    pair_state = state["per_pair"].get(pair, {})
+    current_hash = ema_config_hash(current_ema_config())
+    if "trend_ema_val" in pair_state and pair_state.get("config_hash") != current_hash:
+        clear_ema_state(pair_state)
+        mark_state_dirty()
+    return pair_state.get("trend_ema_val") is None
+
+def clear_ema_state(pair_state):
+    for k in EMA_FIELDS:
+        pair_state.pop(k, None)
+
+# Preallocated ring buffer of recent closes; "head" counts every close written,
+# so the newest close sits at (head - 1) % len(buf)
+def close_buffer(pair_state):
+    buf = pair_state.get("closes_buf")
+    if buf is None:
+        buf = np.zeros(max(state["trend_ema"], state["entry_exit_ema"]) * 4, dtype=np.float32)
+    elif not isinstance(buf, np.ndarray):
+        buf = np.array(buf, dtype=np.float32)  # restored from bot_state.json
+    pair_state["closes_buf"] = buf
+    return buf
+
+# Write closes of bars newer than last_ts into the pair's ring buffer
+def push_new_closes(pair_state, times, closes):
+    last_ts = pair_state.get("last_ts")
+    if last_ts is not None:
+        newer = times > np.datetime64(last_ts)
+        times, closes = times[newer], closes[newer]
+    if len(closes) == 0:
+        return closes
+    buf = close_buffer(pair_state)
+    head = pair_state.get("head", 0)
+    for c in closes[-len(buf):]:
+        buf[head % len(buf)] = c
+        head += 1
+    pair_state["head"] = head
+    pair_state["last_ts"] = str(times[-1])
+    return closes
+
+def latest_closes(pair_state):
+    buf, head = pair_state["closes_buf"], pair_state["head"]
+    close = buf[(head - 1) % len(buf)]
+    prev_close = buf[(head - 2) % len(buf)] if head >= 2 else close
+    return prev_close, close
+
+SIDE_CODES = {None: 0, "BUY": 1, "SELL": -1}
+
+# Warmup seeds memoized on (history digest, spans), so re-seeding an unchanged
+# history (e.g. /setema back and forth within a bar) skips the EMA pass
+WARMUP_MEMO_SIZE = 512
+_warmup_memo = OrderedDict()
+
+def history_digest(closes):
+    return hashlib.blake2b(closes.tobytes(), digest_size=16).digest()
+
+def remember_seed(key, seed):
+    _warmup_memo[key] = seed
+    if len(_warmup_memo) > WARMUP_MEMO_SIZE:
+        _warmup_memo.popitem(last=False)
+
+# Seed EMAs for every pair that needs a warmup this tick. Memo misses run as one
+# vectorized pass when many pairs start cold at once (startup, /setema),
+# otherwise through the per-pair kernel. Returns the seeds and the config hash
+# they were computed under.
+def warmup_emas(histories, config):
+    _, trend_span, entry_span = config
+    seeds, misses = {}, []
+    for p, h in histories:
+        key = (history_digest(h), trend_span, entry_span)
+        if key in _warmup_memo:
+            _warmup_memo.move_to_end(key)
+            seeds[p] = _warmup_memo[key]
+        else:
+            misses.append((p, h, key))
+    if len(misses) > BATCH_WARMUP_MIN_PAIRS:
+        batch = ema_warmup_batch([h for _, h, _ in misses], trend_span, entry_span)
+        computed = [tuple(seed.tolist()) for seed in batch]
+    else:
+        computed = [ema_warmup(h, trend_span, entry_span) for _, h, _ in misses]
+    for (p, _, key), seed in zip(misses, computed):
+        remember_seed(key, seed)
+        seeds[p] = seed
+    return seeds, ema_config_hash(config)
+
+# Fold new bars into the pair's EMAs; returns its signal-matrix row or None
+def update_pair(pair, ohlc, config, seed=None, seed_hash=None):
+    if ohlc is None or len(ohlc[1]) == 0:
+        return None
+    times, history = ohlc
     pair_state = state["per_pair"].setdefault(pair, {"in_trade": False, "side": None})
+    last_ts = pair_state.get("last_ts")
+    if last_ts is not None and times[0] > np.datetime64(last_ts):
+        # Bars are missing since last_ts (e.g. after a long downtime): re-seed
+        # from the full history on the next tick
+        clear_ema_state(pair_state)
+        mark_state_dirty()
+        return None
+    cold = pair_state.get("trend_ema_val") is None
+    if cold:
+        if seed is None:
+            return None
+        clear_ema_state(pair_state)  # start the close buffer from scratch
+    new_closes = push_new_closes(pair_state, times, history)
+    if len(new_closes) == 0:
+        return None
 
+    if cold:
+        # Cold start: EMAs seeded over the full fetched history by warmup_emas
+        trend, entry, prev_close, close = seed
+        pair_state["config_hash"] = seed_hash
+    else:
+        # Incremental: m_t = a*p_t + (1-a)*m_{t-1} for each new bar
+        _, trend_span, entry_span = config
+        ema_step = make_ema_step(trend_span, entry_span)
+        trend, entry = ema_step(new_closes, pair_state["trend_ema_val"], pair_state["entry_ema_val"])
+        prev_close, close = latest_closes(pair_state)
+    pair_state["trend_ema_val"] = trend
+    pair_state["entry_ema_val"] = entry
+    mark_state_dirty()
+    return [close, trend, entry, prev_close, SIDE_CODES[pair_state["side"]]]
+
+def apply_signal(dispatcher, pair, chat_id, signal):
+    pair_state = state["per_pair"][pair]
+
+    # Sent from the dispatcher's worker pool so Telegram round trips never
+    # hold up evaluation of the remaining pairs
     def alert(msg):
         ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
-        send_message(chat_id, f"<b>{pair} — {state['timeframe']}</b>\n{msg}\n<i>{ts}</i>")
-
-    # BUY
-    if close > trend:
-        if not pair_state["in_trade"]:
-            if float(prev["Close"]) <= entry and close > entry:
-                pair_state["in_trade"] = True
-                pair_state["side"] = "BUY"
-                alert("✅ <b>BUY NOW</b>")
-        else:
-            if pair_state["side"] == "BUY":
-                if float(prev["Close"]) >= entry and close < entry:
-                    pair_state["in_trade"] = False
-                    pair_state["side"] = None
-                    alert("❌ <b>EXIT BUY</b>")
-
-    # SELL
-    elif close < trend:
-        if not pair_state["in_trade"]:
-            if float(prev["Close"]) >= entry and close < entry:
-                pair_state["in_trade"] = True
-                pair_state["side"] = "SELL"
-                alert("✅ <b>SELL NOW</b>")
-        else:
-            if pair_state["side"] == "SELL":
-                if float(prev["Close"]) <= entry and close > entry:
-                    pair_state["in_trade"] = False
-                    pair_state["side"] = None
-                    alert("❌ <b>EXIT SELL</b>")
+        text = f"<b>{pair} — {state['timeframe']}</b>\n{msg}\n<i>{ts}</i>"
+        dispatcher.run_async(send_message, chat_id, text)
+
+    if signal == BUY_ENTRY:
+        pair_state["in_trade"] = True
+        pair_state["side"] = "BUY"
+        alert("✅ <b>BUY NOW</b>")
+    elif signal == BUY_EXIT:
+        pair_state["in_trade"] = False
+        pair_state["side"] = None
+        alert("❌ <b>EXIT BUY</b>")
+    elif signal == SELL_ENTRY:
+        pair_state["in_trade"] = True
+        pair_state["side"] = "SELL"
+        alert("✅ <b>SELL NOW</b>")
+    elif signal == SELL_EXIT:
+        pair_state["in_trade"] = False
+        pair_state["side"] = None
+        alert("❌ <b>EXIT SELL</b>")
+
+# Update every pair, then evaluate all crossovers in one vectorized pass and
+# only touch the pairs that actually signalled
+# Wait for the fetch futures; runs without _state_lock so handlers are not
+# blocked on network I/O
+def collect_fetches(fetches):
+    fetched = []
+    for p, outputsize, fetch in fetches:
+        try:
+            fetched.append((p, outputsize, fetch.result()))
+        except Exception:
+            logger.exception("Error fetching %s", p)
+    return fetched
 
-    state["per_pair"][pair] = pair_state
-    save_state(state)
+def evaluate_pairs(dispatcher, chat_id, fetched):
+    config = current_ema_config()
+    # Only seed from full histories: a pair that went cold while its compact
+    # fetch was in flight (e.g. /setema) gets no seed and fetches "full" next tick
+    try:
+        cold = [(p, outputsize, ohlc) for p, outputsize, ohlc in fetched
+                if ohlc is not None and needs_warmup(p)]
+        seeds, seed_hash = warmup_emas([(p, ohlc[1]) for p, outputsize, ohlc in cold
+                                        if outputsize == "full"], config)
+    except Exception:
+        logger.exception("Error warming up EMAs")
+        seeds, seed_hash = {}, None
+
+    pairs, rows = [], []
+    for p, _, ohlc in fetched:
+        try:
+            row = update_pair(p, ohlc, config, seeds.get(p), seed_hash)
+        except Exception:
+            logger.exception("Error evaluating %s", p)
+            continue
+        if row is not None:
+            pairs.append(p)
+            rows.append(row)
+    if not rows:
+        return
+    signals = crossover_signals(np.array(rows, dtype=np.float32))
+    for i in np.flatnonzero(signals):
+        try:
+            apply_signal(dispatcher, pairs[i], chat_id, signals[i])
+        except Exception:
+            logger.exception("Error signalling %s", pairs[i])
 
 # -------------------
 # Monitoring loop
@@ -182,12 +434,19 @@ def monitoring_loop(dispatcher: Dispatcher):
             if not chat_id:
                 time.sleep(5)
                 continue
-            for p in state.get("pairs", []):
-                try:
-                    evaluate_pair(p, chat_id)
-                except Exception:
-                    logger.exception("Error evaluating %s", p)
-            time.sleep(CHECK_INTERVAL_SECONDS)
+            tick_start = time.monotonic()
+            # Fetch all pairs concurrently, then evaluate them together
+            with _state_lock:
+                timeframe = state["timeframe"]
+                fetches = []
+                for p in state.get("pairs", []):
+                    outputsize = "full" if needs_warmup(p) else "compact"
+                    fetches.append((p, outputsize, fetch_pool.submit(fetch_ohlc_fx, p, timeframe, outputsize)))
+            fetched = collect_fetches(fetches)
+            with _state_lock:
+                evaluate_pairs(dispatcher, chat_id, fetched)
+                flush_state()
+            time.sleep(max(0, CHECK_INTERVAL_SECONDS - (time.monotonic() - tick_start)))
         except Exception:
             logger.exception("Unexpected error in monitoring loop")
             time.sleep(5)
@@ -196,8 +455,9 @@ def monitoring_loop(dispatcher: Dispatcher):
 # Telegram Handlers
 def start(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
-    state[DEFAULT_CHAT_ID_KEY] = chat_id
-    save_state(state)
+    with _state_lock:
+        state[DEFAULT_CHAT_ID_KEY] = chat_id
+        save_state(state)
     update.message.reply_text(
         "Hello! EMA‑Signal Bot ready.\nUse buttons below.",
         reply_markup=control_keyboard(state.get("running", False))
@@ -207,12 +467,14 @@ def button_cb(update: Update, context: CallbackContext):
     q = update.callback_query
     q.answer()
     if q.data == "start":
-        state["running"] = True
-        save_state(state)
+        with _state_lock:
+            state["running"] = True
+            save_state(state)
         q.edit_message_text("▶️ Bot started.", reply_markup=control_keyboard(True))
     elif q.data == "stop":
-        state["running"] = False
-        save_state(state)
+        with _state_lock:
+            state["running"] = False
+            save_state(state)
         q.edit_message_text("🛑 Bot stopped.", reply_markup=control_keyboard(False))
     elif q.data == "status":
         running = state.get("running", False)
@@ -230,12 +492,15 @@ def add_pair_command(update: Update, context: CallbackContext):
         update.message.reply_text("Usage: /add <PAIR> e.g. /add GBPUSD")
         return
     pair = context.args[0].upper()
-    if pair in state["pairs"]:
+    with _state_lock:
+        added = pair not in state["pairs"]
+        if added:
+            state["pairs"].append(pair)
+            state["per_pair"].setdefault(pair, {"in_trade": False, "side": None})
+            save_state(state)
+    if not added:
         update.message.reply_text(f"{pair} already monitored.")
         return
-    state["pairs"].append(pair)
-    state["per_pair"].setdefault(pair, {"in_trade": False, "side": None})
-    save_state(state)
     update.message.reply_text(f"Added {pair}.")
 
 def remove_pair_command(update: Update, context: CallbackContext):
@@ -243,12 +508,16 @@ def remove_pair_command(update: Update, context: CallbackContext):
         update.message.reply_text("Usage: /remove <PAIR>")
         return
     pair = context.args[0].upper()
-    if pair not in state["pairs"]:
+    with _state_lock:
+        removed = pair in state["pairs"]
+        if removed:
+            state["pairs"].remove(pair)
+            state["per_pair"].pop(pair, None)
+            evict_ohlc_cache(pair)
+            save_state(state)
+    if not removed:
         update.message.reply_text(f"{pair} not in watchlist.")
         return
-    state["pairs"].remove(pair)
-    state["per_pair"].pop(pair, None)
-    save_state(state)
     update.message.reply_text(f"Removed {pair}.")
 
 def set_ema_command(update: Update, context: CallbackContext):
@@ -262,13 +531,17 @@ def set_ema_command(update: Update, context: CallbackContext):
         update.message.reply_text("Period must be integer.")
         return
     if which == "trend":
-        state["trend_ema"] = val
+        key = "trend_ema"
     elif which in ("entry", "exit", "entry_exit"):
-        state["entry_exit_ema"] = val
+        key = "entry_exit_ema"
     else:
         update.message.reply_text("Which must be 'trend' or 'entry'.")
         return
-    save_state(state)
+    with _state_lock:
+        state[key] = val
+        # Stored EMAs no longer match the config hash and are re-seeded on the next tick
+        make_ema_step.cache_clear()
+        save_state(state)
     update.message.reply_text(f"Set {which} EMA to {val}.")
 
 # -------------------
@@ -0,0 +1,94 @@
+import functools
+
+import numpy as np
+from numba import float32, int64, jit, njit
+from scipy.signal import lfilter
+
+# -------------------
+# Crossover signals
+NO_SIGNAL = 0
+BUY_ENTRY = 1
+BUY_EXIT = 2
+SELL_ENTRY = 3
+SELL_EXIT = 4
+
+# Columns of the per-pair signal matrix; SIDE is 0 flat, 1 long, -1 short
+CLOSE, TREND, ENTRY, PREV_CLOSE, SIDE = range(5)
+
+# TRANSITIONS[side + 1, trend_side + 1, cross + 1] -> signal, where trend_side
+# is the sign of close - trend and cross is +1 / -1 for an upward / downward
+# cross of the entry EMA. Above the trend EMA an upward cross opens a BUY and
+# a downward cross closes it; below the trend EMA the roles are mirrored.
+TRANSITIONS = np.zeros((3, 3, 3), dtype=np.int8)
+TRANSITIONS[1, 2, 2] = BUY_ENTRY
+TRANSITIONS[2, 2, 0] = BUY_EXIT
+TRANSITIONS[1, 0, 0] = SELL_ENTRY
+TRANSITIONS[0, 0, 2] = SELL_EXIT
+
+def crossover_signals(rows):
+    close, trend, entry = rows[:, CLOSE], rows[:, TREND], rows[:, ENTRY]
+    prev_close = rows[:, PREV_CLOSE]
+    side = rows[:, SIDE].astype(np.int8)
+    trend_side = np.greater(close, trend).astype(np.int8) - np.less(close, trend)
+    up_cross = np.less_equal(prev_close, entry) & np.greater(close, entry)
+    down_cross = np.greater_equal(prev_close, entry) & np.less(close, entry)
+    cross = up_cross.astype(np.int8) - down_cross
+    return TRANSITIONS[side + 1, trend_side + 1, cross + 1]
+
+# -------------------
+# Warmup kernel: both EMAs (adjust=False) and the last two closes in one pass.
+# Closes are float32; the EMA accumulators stay float64 so rounding does not
+# build up over thousands of bars.
+@jit((float32[:], int64, int64), nopython=True, nogil=True, cache=True)
+def ema_warmup(closes, trend_span, entry_span):
+    a_trend = 2.0 / (trend_span + 1)
+    a_entry = 2.0 / (entry_span + 1)
+    trend = np.float64(closes[0])
+    entry = np.float64(closes[0])
+    prev_close = closes[0]
+    close = closes[0]
+    for i in range(1, closes.shape[0]):
+        prev_close = close
+        close = closes[i]
+        trend = a_trend * close + (1.0 - a_trend) * trend
+        entry = a_entry * close + (1.0 - a_entry) * entry
+    return trend, entry, prev_close, close
+
+# -------------------
+# Batched warmup: stack the histories into an (N_pairs, T) matrix and run each
+# EMA as one lfilter call along axis=1. Shorter histories are left-padded with
+# their first close; an adjust=False EMA over that constant prefix stays at the
+# first close, so padding leaves every row's result unchanged.
+def ema_warmup_batch(histories, trend_span, entry_span):
+    # float32 closes are widened to float64 so lfilter accumulates at the same
+    # precision as ema_warmup and both warmup paths give the same seeds
+    T = max(len(h) for h in histories)
+    closes = np.empty((len(histories), T), dtype=np.float64)
+    for i, h in enumerate(histories):
+        closes[i, :T - len(h)] = h[0]
+        closes[i, T - len(h):] = h
+    out = np.empty((len(histories), 4), dtype=np.float64)
+    for col, span in ((0, trend_span), (1, entry_span)):
+        a = 2.0 / (span + 1)
+        y, _ = lfilter([a], [1.0, a - 1.0], closes, axis=1, zi=(1.0 - a) * closes[:, :1])
+        out[:, col] = y[:, -1]
+    out[:, 2] = closes[:, max(T - 2, 0)]
+    out[:, 3] = closes[:, -1]
+    return out  # rows of (trend, entry, prev_close, close), like ema_warmup
+
+# -------------------
+# Incremental kernel specialized per (trend_span, entry_span): the smoothing
+# constants are closure variables, which numba freezes into the compiled code
+@functools.cache
+def make_ema_step(trend_span, entry_span):
+    a_trend = 2.0 / (trend_span + 1)
+    a_entry = 2.0 / (entry_span + 1)
+
+    @njit(nogil=True)
+    def ema_step(closes, trend, entry):
+        for i in range(closes.shape[0]):
+            trend = a_trend * closes[i] + (1.0 - a_trend) * trend
+            entry = a_entry * closes[i] + (1.0 - a_entry) * entry
+        return trend, entry
+
+    return ema_step